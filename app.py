@@ -1,8 +1,35 @@
-from flask import Flask, request, jsonify
+# Deve ocorrer antes de qualquer import de rede (requests, socket, threading):
+# torna o I/O bloqueante cooperativo para os workers gevent do gunicorn.
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from gevent.threadpool import ThreadPool
+
+from flask import Flask, Response, request
 from flask_cors import CORS
-from datetime import datetime
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from cachetools import TTLCache
+from array import array
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import hashlib
+import hmac
+import ijson
+import logging
+import math
+import numpy as np
+import orjson
 import os
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper())
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 # Configuração explícita do CORS para permitir todas as origens, métodos e headers
@@ -15,63 +42,274 @@ CORS(app,
 
 # Segurança simples por token
 API_KEY = os.environ.get("API_KEY", "MINHA_CHAVE")
+_API_KEY_BYTES = API_KEY.encode()
 
 # Configuração da API externa de monitoramento
 EXTERNAL_API_URL = os.environ.get("EXTERNAL_API_URL", "https://teste.net")
 EXTERNAL_API_KEY = os.environ.get("EXTERNAL_API_KEY", "123456789")
+# URL fixa da janela recente, montada uma única vez
+_PM25_URL = f"{EXTERNAL_API_URL}?last_minutes=15&api_key={EXTERNAL_API_KEY}"
+
+# Cache em memória das respostas da API externa (em segundos)
+# Até PM25_CACHE_TTL o valor é fresco; até PM25_CACHE_STALE_TTL ele ainda é servido
+# enquanto uma atualização roda em segundo plano (stale-while-revalidate).
+PM25_CACHE_TTL = float(os.environ.get("PM25_CACHE_TTL", "10"))
+PM25_CACHE_STALE_TTL = float(os.environ.get("PM25_CACHE_STALE_TTL", "60"))
+# Após uma falha da API externa, novas buscas síncronas aguardam este intervalo
+PM25_ERROR_BACKOFF = float(os.environ.get("PM25_ERROR_BACKOFF", "5"))
+# Intervalo da atualização periódica em segundo plano.
+# Com 0 o refresher não roda e cada GET /rele consulta o cache stale-while-revalidate.
+REFRESH_INTERVAL_S = float(os.environ.get("REFRESH_INTERVAL_S", "10"))
+
+# Sessão HTTP com pool de conexões keep-alive para a API externa
+# (evita novo handshake TCP/TLS a cada requisição)
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+_ADAPTER = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    # Retenta apenas falhas de conexão e 502/503/504; timeouts de leitura não são
+    # retentados para não estourar o tempo de resposta de quem espera a busca
+    max_retries=Retry(total=2, connect=2, read=0, status=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
+
+_PM25_CACHE = {"value": None, "fresh_until": 0.0, "stale_until": 0.0, "failed_until": 0.0}
+_PM25_CACHE_LOCK = threading.Lock()
+_PM25_FETCH_LOCK = threading.Lock()
+_PM25_REFRESHING = threading.Event()
+_PM25_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pm25-refresh")
+
+# Limiar de aumento entre leituras consecutivas considerado drástico
+DRASTIC_INCREASE_THRESHOLD = 5
+
+# Pool compartilhado para executar em paralelo as buscas independentes dos handlers
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rele-io")
+
+# Busca de pm2_5 sob demanda em andamento (single-flight): no máximo uma por vez
+_pm25_fetch_future = None
+_PM25_FETCH_FUTURE_LOCK = threading.Lock()
+
+# /rele/picos: resultado por (start, end) em cache e range máximo aceito
+PICOS_CACHE_TTL = float(os.environ.get("PICOS_CACHE_TTL", "300"))
+PICOS_MAX_RANGE_HOURS = float(os.environ.get("PICOS_MAX_RANGE_HOURS", "24"))
+PICOS_TIMEOUT = 10
+
+# Cabeçalhos de cache HTTP. "private": as respostas dependem da api_key e não
+# devem ser compartilhadas por caches intermediários.
+# GET /rele altera o estado (consome o desired manual), então todo poll deve chegar
+# ao servidor: "no-cache" força a revalidação, e o ETag/304 mantém a economia de banda.
+_RELE_CACHE_CONTROL = "private, no-cache"
+# delta-seconds do Cache-Control precisa ser inteiro
+_PICOS_CACHE_CONTROL = f"private, max-age={math.ceil(PICOS_CACHE_TTL)}"
+
+_PICOS_CACHE = TTLCache(maxsize=512, ttl=PICOS_CACHE_TTL)
+_PICOS_CACHE_LOCK = threading.Lock()
+
+# /rele/picos tem pools próprios para não ocupar os slots do EXECUTOR usados por /rele:
+# - _PICOS_EXECUTOR: busca na API externa (I/O; greenlets sob o monkey-patch do gevent)
+# - _PICOS_CPU_POOL: threads nativas do gevent para o cálculo dos picos, que assim
+#   não bloqueia o loop do worker
+_PICOS_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="picos-io")
+_PICOS_CPU_POOL = ThreadPool(2)
+
+@dataclass(frozen=True, slots=True)
+class RelayState:
+    """
+    Snapshot imutável do estado do relé.
+    Leituras apenas pegam a referência atual; escritas trocam o snapshot inteiro sob _STATE_LOCK.
+    """
+    desired: str = "off"
+    last_applied: str = "off"
+    last_seen: str | None = None
+    manual_desired_used: bool = False  # Flag para rastrear se o desired manual já foi usado uma vez
 
 # Estado desejado e último estado aplicado (em memória)
-STATE = {
-    "desired": "off",
-    "last_applied": "off",
-    "last_seen": None,
-    "manual_desired_used": False  # Flag para rastrear se o desired manual já foi usado uma vez
-}
+_state = RelayState()
+_STATE_LOCK = threading.Lock()
+
+@dataclass(frozen=True, slots=True)
+class Pm25Snapshot:
+    """
+    Série de pm2_5 mais recente e sua detecção, publicada pelo refresher.
+    Compartilhada por todos os clientes; trocada por inteiro a cada atualização.
+    """
+    pm25_values: list
+    detection: tuple
+    computed_at: float  # time.monotonic() da publicação
+
+_pm25_snapshot = None
+_SNAPSHOT_LOCK = threading.Lock()
+# Idade máxima do snapshot: ao menos algumas execuções do refresher, para que ele não
+# expire entre duas atualizações quando REFRESH_INTERVAL_S >= PM25_CACHE_STALE_TTL
+_SNAPSHOT_MAX_AGE = max(PM25_CACHE_STALE_TTL, 3 * REFRESH_INTERVAL_S)
+
+# Última resposta serializada de GET /rele: (Pm25Snapshot, RelayState, corpo em bytes, ETag).
+# É trocada por inteiro a cada atualização, como o _state.
+_rele_memo = None
+
+def _json(obj, status=200):
+    """
+    Serializa obj com orjson e retorna a Response JSON.
+    """
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+def _etag(body):
+    """
+    ETag curto derivado do corpo serializado.
+    """
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def _cacheable_json(body, etag, cache_control):
+    """
+    Retorna a Response JSON com Cache-Control e ETag.
+    Responde 304 sem corpo quando o If-None-Match do cliente corresponde.
+    """
+    resp = Response(body, status=200, mimetype="application/json")
+    resp.headers["Cache-Control"] = cache_control
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+def _key_matches(key):
+    """
+    Compara a chave recebida com API_KEY em tempo constante.
+    """
+    return bool(key) and hmac.compare_digest(key.encode(), _API_KEY_BYTES)
+
+def _extract_key(data):
+    """
+    Extrai a chave de um mapeamento (querystring/form/JSON).
+    Aceita api_key, apikey (sem underscore) ou key.
+    """
+    key = data.get("api_key") or data.get("apikey") or data.get("key") or ""
+    return key.strip() if isinstance(key, str) else ""
+
+def _header_key_ok():
+    """
+    Caminho rápido: valida apenas o header X-API-Key, sem montar dicionários nem ler o corpo.
+    """
+    return _key_matches(request.headers.get("X-API-Key", "").strip())
+
+def _query_key_ok():
+    """
+    Valida a chave da querystring (api_key, apikey ou key) sem copiar request.args.
+    """
+    return _key_matches(_extract_key(request.args))
 
 def _validate_api_key():
     """
     Valida a api_key da requisição.
-    Aceita api_key via querystring, form, JSON ou header.
+    Aceita api_key via header X-API-Key, querystring, form ou JSON.
+    Usado por handlers que leem o corpo (POST); os GET usam apenas header e querystring.
     Retorna (True, api_key) se válida, (False, None) caso contrário.
     """
-    data = {}
-    data.update(request.args.to_dict(flat=True))
-    if request.form:
-        data.update(request.form.to_dict(flat=True))
-    if request.is_json:
+    header_key = request.headers.get("X-API-Key", "").strip()
+    if _key_matches(header_key):
+        return True, header_key
+
+    # Fallback em ordem crescente de custo: querystring, form e, por último, JSON
+    api_key = _extract_key(request.args)
+    if not api_key and request.form:
+        api_key = _extract_key(request.form)
+    if not api_key and request.is_json:
         js = request.get_json(silent=True) or {}
         if isinstance(js, dict):
-            data.update(js)
-    
-    # Aceita api_key, apikey (sem underscore) ou key na querystring/form/JSON
-    api_key = (data.get("api_key") or data.get("apikey") or data.get("key") or "").strip()
-    
-    # Também aceita no header X-API-Key
-    header_key = request.headers.get("X-API-Key", "").strip()
-    
-    # Verifica se alguma das chaves corresponde
-    final_key = api_key or header_key
-    
-    # Debug: log para identificar o problema (remover em produção)
-    if not final_key or final_key != API_KEY:
-        print(f"[DEBUG] API_KEY esperada: '{API_KEY}'")
-        print(f"[DEBUG] Chave recebida (querystring/form/json): '{api_key}'")
-        print(f"[DEBUG] Chave recebida (header): '{header_key}'")
-        print(f"[DEBUG] Chave final usada: '{final_key}'")
-        print(f"[DEBUG] Match: {final_key == API_KEY}")
+            api_key = _extract_key(js)
+
+    # Nunca registra as chaves em log (nem a esperada nem a recebida)
+    if not _key_matches(api_key):
+        logger.debug("api_key inválida ou ausente")
         return False, None
-    return True, final_key
+    return True, api_key
 
 def fetch_pm25_data():
+    """
+    Busca dados de pm2_5 da API externa usando cache stale-while-revalidate.
+    - Fresco: retorna o valor em cache.
+    - Velho (dentro de PM25_CACHE_STALE_TTL): retorna o cache e atualiza em segundo plano.
+    - Expirado: busca de forma síncrona; em caso de erro, retorna o último valor conhecido.
+    - Falha recente (dentro de PM25_ERROR_BACKOFF): não busca, retorna o último valor conhecido.
+    Retorna lista de valores de pm2_5 ou None se nunca houve dados.
+    """
+    now = time.monotonic()
+    with _PM25_CACHE_LOCK:
+        value = _PM25_CACHE["value"]
+        fresh_until = _PM25_CACHE["fresh_until"]
+        stale_until = _PM25_CACHE["stale_until"]
+        failed_until = _PM25_CACHE["failed_until"]
+
+    if value is not None and now < fresh_until:
+        return value
+    if value is not None and now < stale_until:
+        _schedule_pm25_refresh()
+        return value
+    if now < failed_until:
+        return value
+
+    # Fora da janela: apenas uma requisição busca, as demais aguardam o resultado.
+    # Quem esperou no lock reaproveita o resultado de quem buscou, com sucesso ou falha.
+    with _PM25_FETCH_LOCK:
+        with _PM25_CACHE_LOCK:
+            now = time.monotonic()
+            if _PM25_CACHE["value"] is not None and now < _PM25_CACHE["fresh_until"]:
+                return _PM25_CACHE["value"]
+            if now < _PM25_CACHE["failed_until"]:
+                return _PM25_CACHE["value"]
+        pm25_values = _refresh_pm25_cache()
+
+    if pm25_values is None:
+        # Fallback: mantém a última série conhecida em vez de falhar
+        with _PM25_CACHE_LOCK:
+            return _PM25_CACHE["value"]
+    return pm25_values
+
+def _schedule_pm25_refresh():
+    """
+    Agenda uma atualização do cache em segundo plano, se nenhuma estiver em andamento.
+    """
+    with _PM25_CACHE_LOCK:
+        if _PM25_REFRESHING.is_set():
+            return
+        _PM25_REFRESHING.set()
+    try:
+        _PM25_REFRESH_EXECUTOR.submit(_background_pm25_refresh)
+    except RuntimeError:
+        _PM25_REFRESHING.clear()
+
+def _background_pm25_refresh():
+    try:
+        _refresh_pm25_cache()
+    finally:
+        _PM25_REFRESHING.clear()
+
+def _refresh_pm25_cache():
+    """
+    Busca dados na API externa e, se bem-sucedido, atualiza o cache.
+    Erros não são cacheados: o último valor conhecido é mantido e o horário
+    da falha é registrado para o backoff das buscas síncronas.
+    """
+    pm25_values = _fetch_pm25_data_uncached()
+    now = time.monotonic()
+    with _PM25_CACHE_LOCK:
+        if pm25_values is not None:
+            _PM25_CACHE["value"] = pm25_values
+            _PM25_CACHE["fresh_until"] = now + PM25_CACHE_TTL
+            _PM25_CACHE["stale_until"] = now + PM25_CACHE_STALE_TTL
+            _PM25_CACHE["failed_until"] = 0.0
+        else:
+            _PM25_CACHE["failed_until"] = now + PM25_ERROR_BACKOFF
+    return pm25_values
+
+def _fetch_pm25_data_uncached():
     """
     Busca dados de pm2_5 da API externa (tabela entries_sps30).
     Retorna lista de valores de pm2_5 ou None em caso de erro.
     """
     try:
-        url = f"{EXTERNAL_API_URL}?last_minutes=15&api_key={EXTERNAL_API_KEY}"
-        response = requests.get(url, timeout=5)
+        response = SESSION.get(_PM25_URL, timeout=(1.0, 5.0), stream=False)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         if data.get("ok") and "series" in data:
             # Adaptado para nova estrutura: busca pm2_5 ao invés de pm25
@@ -81,34 +319,70 @@ def fetch_pm25_data():
             return pm25_values
         return None
     except Exception as e:
-        print(f"[ERROR] Erro ao buscar dados da API externa: {e}")
+        logger.error("Erro ao buscar dados da API externa: %s", e)
         return None
 
+# Eventos do ijson que carregam um valor escalar
+_JSON_SCALAR_EVENTS = frozenset(("null", "boolean", "integer", "double", "number", "string"))
+
 def fetch_pm25_data_by_range(start_date, end_date):
     """
     Busca dados de pm2_5 da API externa por range de datas (tabela entries_sps30).
+    A resposta é lida em streaming e apenas ok, labels e series.pm2_5/pm25 são extraídos,
+    sem materializar o JSON inteiro em memória.
     Retorna (labels, pm25_values) ou (None, None) em caso de erro.
     """
     try:
-        url = f"{EXTERNAL_API_URL}?start={start_date}&end={end_date}&api_key={EXTERNAL_API_KEY}"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        # params= deixa o escape dos valores (ex.: "+" em fusos horários) para o requests
+        with SESSION.get(
+            EXTERNAL_API_URL,
+            params={"start": start_date, "end": end_date, "api_key": EXTERNAL_API_KEY},
+            timeout=(1.0, 10.0),
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            # Descomprime gzip ao ler o corpo bruto
+            response.raw.decode_content = True
+            ok, labels, series = _parse_range_payload(response.raw)
         
-        if data.get("ok") and "series" in data and "labels" in data:
-            labels = data.get("labels", [])
+        if ok and labels is not None and series:
             # Adaptado para nova estrutura: busca pm2_5 ao invés de pm25
-            pm25_values = data["series"].get("pm2_5", data["series"].get("pm25", []))
-            # Remove valores None e mantém correspondência com labels
-            filtered_data = [(label, float(val)) for label, val in zip(labels, pm25_values) if val is not None]
+            pm25_values = series.get("pm2_5", series.get("pm25", ()))
+            # Remove valores None (NaN) e mantém correspondência com labels
+            filtered_data = [(label, val) for label, val in zip(labels, pm25_values) if val == val]
             if filtered_data:
                 labels_filtered, values_filtered = zip(*filtered_data)
                 return list(labels_filtered), list(values_filtered)
         return None, None
     except Exception as e:
-        print(f"[ERROR] Erro ao buscar dados da API externa por range: {e}")
+        logger.error("Erro ao buscar dados da API externa por range: %s", e)
         return None, None
 
+def _parse_range_payload(stream):
+    """
+    Percorre o JSON da API externa com ijson (eventos SAX) guardando apenas o necessário.
+    Valores None da série viram NaN no buffer (array de doubles).
+    Retorna (ok, labels, {"pm2_5": array, "pm25": array}); labels é None se ausente.
+    """
+    ok = None
+    labels = None
+    series = {}
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if event not in _JSON_SCALAR_EVENTS:
+            if event == "start_array":
+                if prefix == "labels":
+                    labels = []
+                elif prefix in ("series.pm2_5", "series.pm25"):
+                    series[prefix[7:]] = array("d")
+            continue
+        if prefix == "labels.item":
+            labels.append(value)
+        elif prefix == "series.pm2_5.item" or prefix == "series.pm25.item":
+            series[prefix[7:-5]].append(float("nan") if value is None else float(value))
+        elif prefix == "ok":
+            ok = value
+    return ok, labels, series
+
 def detect_drastic_increase(pm25_values):
     """
     Detecta aumento drástico de 5 ou mais no pm2_5 entre leituras consecutivas.
@@ -119,50 +393,80 @@ def detect_drastic_increase(pm25_values):
     if not pm25_values or len(pm25_values) < 2:
         return False, None, None, None
     
-    # Debug: mostra os valores recebidos
-    print(f"[DEBUG] Valores pm2_5 recebidos: {pm25_values}")
-    print(f"[DEBUG] Total de valores: {len(pm25_values)}")
-    
-    # Verifica todos os aumentos consecutivos e encontra o maior
-    max_increase = 0
-    max_previous = None
-    max_current = None
-    
-    for i in range(1, len(pm25_values)):
-        increase = pm25_values[i] - pm25_values[i-1]
-        print(f"[DEBUG] Comparando: {pm25_values[i-1]} -> {pm25_values[i]} (aumento: {increase})")
-        if increase >= 5 and increase > max_increase:
-            max_increase = increase
-            max_previous = pm25_values[i-1]
-            max_current = pm25_values[i]
+    # Diferenças consecutivas calculadas de uma vez (float64 preserva os valores originais)
+    arr = np.asarray(pm25_values, dtype=np.float64)
+    d = np.diff(arr)
+    idx = np.flatnonzero(d >= DRASTIC_INCREASE_THRESHOLD)
     
-    if max_increase >= 5:
-        print(f"[INFO] Aumento drástico detectado: {max_previous} -> {max_current} (aumento de {max_increase})")
-        return True, max_increase, max_previous, max_current
+    if idx.size == 0:
+        return False, None, None, None
     
-    print(f"[DEBUG] Nenhum aumento drástico detectado (limiar: 5)")
-    return False, None, None, None
+    # argmax retorna a primeira ocorrência do maior aumento
+    i = idx[d[idx].argmax()]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Aumento drástico detectado: %s -> %s (aumento de %s)", arr[i], arr[i + 1], d[i])
+    return True, float(d[i]), float(arr[i]), float(arr[i + 1])
+
+# Formatos aceitos pelos labels, escolhidos pela forma da string (sem tentativa e erro)
+_TS_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
+# Janela de agrupamento de picos, em microssegundos (unidade de datetime64[us])
+_GROUP_WINDOW_US = 5 * 60 * 1_000_000
+_NAT_US = np.iinfo(np.int64).min
 
 def parse_timestamp(ts_str):
     """
     Converte string de timestamp para datetime.
     Aceita formatos ISO com ou sem Z.
     """
-    if not ts_str:
+    if not ts_str or not isinstance(ts_str, str):
         return None
+    # Remove Z se presente
+    ts_str = ts_str.rstrip('Z')
+    if 'T' in ts_str:
+        fmt = _TS_FORMATS[0] if '.' in ts_str else _TS_FORMATS[1]
+    else:
+        fmt = _TS_FORMATS[2]
     try:
-        # Remove Z se presente
-        ts_str = ts_str.rstrip('Z')
-        # Tenta diferentes formatos
-        for fmt in ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]:
-            try:
-                return datetime.strptime(ts_str, fmt)
-            except ValueError:
-                continue
-        return datetime.fromisoformat(ts_str.replace('Z', ''))
-    except Exception:
+        return datetime.strptime(ts_str, fmt)
+    except ValueError:
+        pass
+    # Demais variantes ISO (ex.: com offset de fuso horário)
+    try:
+        return datetime.fromisoformat(ts_str)
+    except ValueError:
         return None
 
+def _to_naive_utc(ts):
+    """
+    Converte datetimes com fuso para UTC sem tzinfo; "Z" já é removido por parse_timestamp,
+    então "...Z" e "...+00:00" passam a ser comparáveis.
+    """
+    if ts is not None and ts.tzinfo is not None:
+        return ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def _parse_labels(labels):
+    """
+    Converte uma lista de labels para datetime64[us] de uma só vez.
+    Labels ausentes ou inválidos viram NaT.
+    """
+    normalized = [label.rstrip('Z') if isinstance(label, str) and label else "NaT" for label in labels]
+    try:
+        # Caminho rápido: o numpy interpreta ISO-8601 nativamente
+        return np.array(normalized, dtype="datetime64[us]")
+    except ValueError:
+        pass
+
+    # Algum label fora do padrão: converte individualmente
+    parsed = np.full(len(normalized), np.datetime64("NaT"), dtype="datetime64[us]")
+    for k, label in enumerate(labels):
+        ts = _to_naive_utc(parse_timestamp(label))
+        if ts is None:
+            continue
+        parsed[k] = np.datetime64(ts, "us")
+    return parsed
+
 def find_all_drastic_increases(labels, pm25_values):
     """
     Encontra todos os aumentos drásticos de 5 ou mais no pm2_5.
@@ -172,67 +476,121 @@ def find_all_drastic_increases(labels, pm25_values):
     if not pm25_values or len(pm25_values) < 2:
         return []
     
-    all_occurrences = []
-    
-    # Primeiro, encontra todos os aumentos drásticos
-    for i in range(1, len(pm25_values)):
-        increase = pm25_values[i] - pm25_values[i-1]
-        if increase >= 5:
-            occurrence = {
-                "timestamp": labels[i] if i < len(labels) else None,
-                "previous_value": pm25_values[i-1],
-                "current_value": pm25_values[i],
-                "increase": increase,
-                "index": i
-            }
-            all_occurrences.append(occurrence)
+    arr = np.asarray(pm25_values, dtype=np.float64)
+    d = np.diff(arr)
+    # Índices (na série) das leituras que tiveram aumento drástico em relação à anterior
+    idx = np.flatnonzero(d >= DRASTIC_INCREASE_THRESHOLD) + 1
     
-    if not all_occurrences:
+    if idx.size == 0:
         return []
     
-    # Agrupa ocorrências próximas (dentro de 5 minutos) e mantém apenas a primeira
+    # Converte apenas os labels das ocorrências candidatas, de uma vez
+    candidate_labels = [labels[i] if i < len(labels) else None for i in idx]
+    candidate_us = _parse_labels(candidate_labels).astype(np.int64).tolist()
+    
+    # Agrupa ocorrências próximas (dentro de 5 minutos) e mantém apenas a primeira.
+    # A comparação é com a última ocorrência mantida, por isso o laço é sequencial
+    # (mas percorre apenas as candidatas, não a série inteira).
     filtered_occurrences = []
-    last_timestamp = None
+    last_us = None
     
-    for occurrence in all_occurrences:
-        current_timestamp = parse_timestamp(occurrence["timestamp"])
-        
-        if current_timestamp is None:
+    for i, label, ts_us in zip(idx.tolist(), candidate_labels, candidate_us):
+        if ts_us == _NAT_US:
             # Se não conseguir parsear, adiciona de qualquer forma
-            filtered_occurrences.append({
-                "timestamp": occurrence["timestamp"],
-                "previous_value": occurrence["previous_value"],
-                "current_value": occurrence["current_value"],
-                "increase": occurrence["increase"]
-            })
-            last_timestamp = None
-            continue
-        
-        # Se é a primeira ocorrência ou está a mais de 5 minutos da anterior
-        if last_timestamp is None:
-            filtered_occurrences.append({
-                "timestamp": occurrence["timestamp"],
-                "previous_value": occurrence["previous_value"],
-                "current_value": occurrence["current_value"],
-                "increase": occurrence["increase"]
-            })
-            last_timestamp = current_timestamp
+            last_us = None
+        elif last_us is None or ts_us - last_us > _GROUP_WINDOW_US:
+            # Primeira ocorrência ou mais de 5 minutos depois da anterior
+            last_us = ts_us
         else:
-            # Calcula diferença em minutos
-            time_diff = (current_timestamp - last_timestamp).total_seconds() / 60
-            if time_diff > 5:
-                # Mais de 5 minutos de diferença, adiciona como nova ocorrência
-                filtered_occurrences.append({
-                    "timestamp": occurrence["timestamp"],
-                    "previous_value": occurrence["previous_value"],
-                    "current_value": occurrence["current_value"],
-                    "increase": occurrence["increase"]
-                })
-                last_timestamp = current_timestamp
             # Se está dentro de 5 minutos, ignora (já temos a primeira da sequência)
+            continue
+        filtered_occurrences.append({
+            "timestamp": label,
+            "previous_value": float(arr[i - 1]),
+            "current_value": float(arr[i]),
+            "increase": float(d[i - 1])
+        })
     
     return filtered_occurrences
 
+def _publish_pm25_snapshot(pm25_values):
+    """
+    Publica a série de pm2_5 e sua detecção como novo Pm25Snapshot.
+    Se a série é a mesma lista já publicada, mantém o snapshot atual.
+    """
+    global _pm25_snapshot
+    with _SNAPSHOT_LOCK:
+        current = _pm25_snapshot
+        if current is not None and current.pm25_values is pm25_values:
+            return current
+        if pm25_values:
+            detection = detect_drastic_increase(pm25_values)
+        else:
+            detection = (False, None, None, None)
+        _pm25_snapshot = snapshot = Pm25Snapshot(pm25_values, detection, time.monotonic())
+        return snapshot
+
+def _snapshot_expired(snapshot):
+    """
+    Indica se o snapshot está ausente ou foi publicado há mais de _SNAPSHOT_MAX_AGE segundos.
+    """
+    return snapshot is None or time.monotonic() - snapshot.computed_at > _SNAPSHOT_MAX_AGE
+
+def _submit_pm25_fetch():
+    """
+    Retorna a busca de pm2_5 sob demanda em andamento ou agenda uma nova no EXECUTOR.
+    Requisições concorrentes aguardam o mesmo future, então a fila nunca cresce
+    durante uma falha da API externa.
+    """
+    global _pm25_fetch_future
+    with _PM25_FETCH_FUTURE_LOCK:
+        future = _pm25_fetch_future
+        if future is None or future.done():
+            _pm25_fetch_future = future = EXECUTOR.submit(fetch_pm25_data)
+        return future
+
+def _refresher():
+    """
+    Atualiza periodicamente a série de pm2_5 e publica o snapshot para todos os clientes.
+    Em caso de erro na API externa, mantém o último snapshot publicado.
+    O jitter evita que os workers atualizem todos ao mesmo tempo.
+    """
+    while True:
+        try:
+            pm25_values = _refresh_pm25_cache()
+            if pm25_values is not None:
+                _publish_pm25_snapshot(pm25_values)
+        except Exception:
+            logger.exception("Erro na atualização periódica de pm2_5")
+        gevent.sleep(REFRESH_INTERVAL_S + random.uniform(0, 0.2 * REFRESH_INTERVAL_S))
+
+def compute_picos(start_date, end_date):
+    """
+    Busca o range na API externa e calcula os picos de aumento drástico.
+    O resultado é cacheado pelo handler em _PICOS_CACHE (único cache de ranges).
+    Retorna a lista de ocorrências ou None se não foi possível buscar os dados.
+    """
+    labels, pm25_values = fetch_pm25_data_by_range(start_date, end_date)
+    if labels is None or pm25_values is None:
+        return None
+    return _PICOS_CPU_POOL.apply(find_all_drastic_increases, (labels, pm25_values))
+
+# (segundo epoch, string ISO) do último timestamp formatado; trocado por inteiro
+_now_cache = (0, "")
+
+def _now_iso_seconds():
+    """
+    datetime.now().isoformat(timespec="seconds"), formatado no máximo uma vez por segundo.
+    """
+    global _now_cache
+    t = int(time.time())
+    cached = _now_cache
+    if cached[0] == t:
+        return cached[1]
+    s = datetime.fromtimestamp(t).isoformat(timespec="seconds")
+    _now_cache = (t, s)
+    return s
+
 def compute_desired_state():
     """
     Exemplo de regra: liga entre 08:00 e 20:00, fora disso desliga.
@@ -244,51 +602,87 @@ def compute_desired_state():
 
 @app.get("/rele")
 def get_rele():
-    is_valid, _ = _validate_api_key()
-    if not is_valid:
-        return jsonify(
-            ok=False, 
-            error="unauthorized",
-            hint="Envie api_key via querystring (?api_key=...), form, JSON ou header X-API-Key"
-        ), 401
-
-    # Busca dados de pm2_5 para análise (tabela entries_sps30)
-    pm25_values = fetch_pm25_data()
-    has_drastic_increase = False
-    increase_amount = None
-    previous_value = None
-    current_value = None
-    
-    if pm25_values:
-        has_drastic_increase, increase_amount, previous_value, current_value = detect_drastic_increase(pm25_values)
-    
-    # Se o desired foi definido manualmente e ainda não foi usado, retorna o valor manual
-    if not STATE["manual_desired_used"]:
-        # Primeira execução depois do POST manual: retorna o valor definido manualmente
-        STATE["manual_desired_used"] = True  # Marca como usado
-        # Mantém o desired atual (definido pelo POST)
+    if not (_header_key_ok() or _query_key_ok()):
+        return _json({
+            "ok": False,
+            "error": "unauthorized",
+            "hint": "Envie api_key via querystring (?api_key=...) ou header X-API-Key"
+        }, 401)
+
+    # Normalmente a série já foi publicada pelo refresher: nenhum I/O na requisição.
+    # Um snapshot velho demais (API externa fora) é ignorado para que o fallback por horário volte a valer.
+    snapshot = _pm25_snapshot
+    if _snapshot_expired(snapshot):
+        snapshot = None
+    # Sem snapshot válido, ou com o refresher desativado, dispara a busca de pm2_5
+    # (tabela entries_sps30, via cache stale-while-revalidate) antes de qualquer trabalho local
+    if snapshot is None or REFRESH_INTERVAL_S <= 0:
+        fut_pm25 = _submit_pm25_fetch()
     else:
-        # A partir da segunda execução: recalcula baseado na detecção de pm2_5
-        if pm25_values:
+        fut_pm25 = None
+    # Enquanto isso, calcula o estado pela regra de horário (usado como fallback)
+    scheduled_desired = compute_desired_state()
+    if fut_pm25 is not None:
+        try:
+            pm25_values = fut_pm25.result(timeout=5)
+        except FutureTimeoutError:
+            # Só cancela se ainda não começou; em execução, a busca termina sozinha
+            fut_pm25.cancel()
+            pm25_values = None
+        except CancelledError:
+            pm25_values = None
+        if pm25_values is not None:
+            # fetch_pm25_data devolve a última série conhecida em caso de erro:
+            # a mesma lista mantém o computed_at original e pode continuar expirada
+            snapshot = _publish_pm25_snapshot(pm25_values)
+            if _snapshot_expired(snapshot):
+                snapshot = None
+
+    if snapshot is not None:
+        pm25_values = snapshot.pm25_values
+        detection = snapshot.detection
+    else:
+        pm25_values = None
+        detection = (False, None, None, None)
+    has_drastic_increase, increase_amount, previous_value, current_value = detection
+
+    global _state, _rele_memo
+    with _STATE_LOCK:
+        current = _state
+        # Se o desired foi definido manualmente e ainda não foi usado, retorna o valor manual.
+        # A verificação e a troca da flag ocorrem sob o lock (compare-and-set), então
+        # apenas um GET concorrente consome o valor manual.
+        if not current.manual_desired_used:
+            # Primeira execução depois do POST manual: mantém o desired definido pelo POST
+            new_state = replace(current, manual_desired_used=True)
+        elif pm25_values:
+            # A partir da segunda execução: recalcula baseado na detecção de pm2_5
             # Se detecta aumento drástico, desired é "on", caso contrário é "off"
             if has_drastic_increase:
-                STATE["desired"] = "on"
-                STATE["last_applied"] = "on"
-                STATE["last_seen"] = datetime.now().isoformat(timespec="seconds")
+                new_state = replace(
+                    current,
+                    desired="on",
+                    last_applied="on",
+                    last_seen=_now_iso_seconds(),
+                )
             else:
-                STATE["desired"] = "off"
-                STATE["last_applied"] = "off"
+                new_state = replace(current, desired="off", last_applied="off")
         else:
             # Se não conseguir buscar dados da API, usa a lógica inicial (horário)
-            desired = compute_desired_state()
-            STATE["desired"] = desired
             # Mantém o valor atual de last_applied se não conseguir buscar dados
+            new_state = replace(current, desired=scheduled_desired)
+        _state = new_state
+
+    # Mesmo snapshot de estado + mesma série publicada: reutiliza o corpo já serializado
+    memo = _rele_memo
+    if memo is not None and memo[0] is snapshot and memo[1] == new_state:
+        return _cacheable_json(memo[2], memo[3], _RELE_CACHE_CONTROL)
 
     response_data = {
         "ok": True,
-        "desired": STATE["desired"],
-        "last_applied": STATE["last_applied"],
-        "last_seen": STATE["last_seen"],
+        "desired": new_state.desired,
+        "last_applied": new_state.last_applied,
+        "last_seen": new_state.last_seen,
         "pm25_detected_increase": has_drastic_increase
     }
     
@@ -298,36 +692,45 @@ def get_rele():
         response_data["pm25_previous_value"] = previous_value
         response_data["pm25_current_value"] = current_value
     
-    return jsonify(response_data), 200
+    body = orjson.dumps(response_data)
+    etag = _etag(body)
+    _rele_memo = (snapshot, new_state, body, etag)
+    return _cacheable_json(body, etag, _RELE_CACHE_CONTROL)
 
 @app.post("/rele")
 def post_rele():
     is_valid, _ = _validate_api_key()
     if not is_valid:
-        return jsonify(
-            ok=False, 
-            error="unauthorized",
-            hint="Envie api_key via querystring (?api_key=...), form, JSON ou header X-API-Key"
-        ), 401
+        return _json({
+            "ok": False,
+            "error": "unauthorized",
+            "hint": "Envie api_key via querystring (?api_key=...), form, JSON ou header X-API-Key"
+        }, 401)
 
     data = request.get_json(silent=True) or {}
     applied = data.get("applied")
     desired = data.get("desired")  # Campo opcional para definir manualmente o estado desejado
 
     if applied not in ("on", "off"):
-        return jsonify(ok=False, error="invalid_applied", hint="applied must be 'on' or 'off'"), 400
+        return _json({"ok": False, "error": "invalid_applied", "hint": "applied must be 'on' or 'off'"}, 400)
+
+    changes = {
+        "last_applied": applied,
+        "last_seen": _now_iso_seconds(),
+    }
 
     # Se desired for fornecido, valida e atualiza o estado desejado manualmente
     if desired is not None:
         if desired not in ("on", "off"):
-            return jsonify(ok=False, error="invalid_desired", hint="desired must be 'on' or 'off'"), 400
-        STATE["desired"] = desired
-        STATE["manual_desired_used"] = False  # Reseta a flag para permitir que o próximo GET use o valor manual
+            return _json({"ok": False, "error": "invalid_desired", "hint": "desired must be 'on' or 'off'"}, 400)
+        changes["desired"] = desired
+        changes["manual_desired_used"] = False  # Reseta a flag para permitir que o próximo GET use o valor manual
 
-    STATE["last_applied"] = applied
-    STATE["last_seen"] = datetime.now().isoformat(timespec="seconds")
+    global _state
+    with _STATE_LOCK:
+        _state = new_state = replace(_state, **changes)
 
-    return jsonify(ok=True, desired=STATE["desired"], recorded=True), 200
+    return _json({"ok": True, "desired": new_state.desired, "recorded": True})
 
 @app.get("/rele/picos")
 def get_picos():
@@ -335,38 +738,68 @@ def get_picos():
     Retorna os picos de aumento drástico de pm2_5 em um range de datas (tabela entries_sps30).
     Parâmetros: start (data inicial), end (data final), api_key
     """
-    is_valid, _ = _validate_api_key()
-    if not is_valid:
-        return jsonify(
-            ok=False, 
-            error="unauthorized",
-            hint="Envie api_key via querystring (?api_key=...), form, JSON ou header X-API-Key"
-        ), 401
+    if not (_header_key_ok() or _query_key_ok()):
+        return _json({
+            "ok": False,
+            "error": "unauthorized",
+            "hint": "Envie api_key via querystring (?api_key=...) ou header X-API-Key"
+        }, 401)
 
     # Obtém parâmetros de data
     start_date = request.args.get("start")
     end_date = request.args.get("end")
     
     if not start_date or not end_date:
-        return jsonify(
-            ok=False,
-            error="missing_parameters",
-            hint="Parâmetros 'start' e 'end' são obrigatórios. Formato: YYYY-MM-DDTHH:MM:SSZ ou YYYY-MM-DDTHH:MM:SS"
-        ), 400
+        return _json({
+            "ok": False,
+            "error": "missing_parameters",
+            "hint": "Parâmetros 'start' e 'end' são obrigatórios. Formato: YYYY-MM-DDTHH:MM:SSZ ou YYYY-MM-DDTHH:MM:SS"
+        }, 400)
+
+    # Limita o range para manter o custo de CPU e de banda da API externa previsível
+    start_ts = _to_naive_utc(parse_timestamp(start_date))
+    end_ts = _to_naive_utc(parse_timestamp(end_date))
+    try:
+        range_hours = (end_ts - start_ts).total_seconds() / 3600
+    except TypeError:
+        range_hours = None
+    if range_hours is None or range_hours < 0:
+        return _json({
+            "ok": False,
+            "error": "invalid_parameters",
+            "hint": "Parâmetros 'start' e 'end' inválidos. Formato: YYYY-MM-DDTHH:MM:SSZ ou YYYY-MM-DDTHH:MM:SS, com start <= end"
+        }, 400)
+    if range_hours > PICOS_MAX_RANGE_HOURS:
+        return _json({
+            "ok": False,
+            "error": "range_too_large",
+            "hint": f"O range entre 'start' e 'end' deve ser de no máximo {PICOS_MAX_RANGE_HOURS:g} horas"
+        }, 400)
+
+    key = (start_date, end_date)
+    with _PICOS_CACHE_LOCK:
+        occurrences = _PICOS_CACHE.get(key)
+
+    if occurrences is None:
+        # Busca e cálculo rodam fora da thread da requisição, com tempo máximo
+        future = _PICOS_EXECUTOR.submit(compute_picos, start_date, end_date)
+        try:
+            occurrences = future.result(timeout=PICOS_TIMEOUT)
+        except FutureTimeoutError:
+            # Descarta a tarefa se ainda estiver na fila
+            future.cancel()
+            occurrences = None
+
+        if occurrences is None:
+            return _json({
+                "ok": False,
+                "error": "data_fetch_failed",
+                "hint": "Não foi possível buscar dados da API externa para o range de datas especificado"
+            }, 500)
+
+        with _PICOS_CACHE_LOCK:
+            _PICOS_CACHE[key] = occurrences
 
-    # Busca dados da API externa por range de datas
-    labels, pm25_values = fetch_pm25_data_by_range(start_date, end_date)
-    
-    if labels is None or pm25_values is None:
-        return jsonify(
-            ok=False,
-            error="data_fetch_failed",
-            hint="Não foi possível buscar dados da API externa para o range de datas especificado"
-        ), 500
-
-    # Encontra todos os aumentos drásticos
-    occurrences = find_all_drastic_increases(labels, pm25_values)
-    
     response_data = {
         "ok": True,
         "start_date": start_date,
@@ -375,8 +808,14 @@ def get_picos():
         "occurrences": occurrences
     }
     
-    return jsonify(response_data), 200
+    body = orjson.dumps(response_data)
+    return _cacheable_json(body, _etag(body), _PICOS_CACHE_CONTROL)
+
+# Um único refresher por processo (worker) mantém a série atualizada
+if REFRESH_INTERVAL_S > 0:
+    gevent.spawn(_refresher)
 
 if __name__ == "__main__":
-    # Em produção, prefira gunicorn/uwsgi atrás de um proxy.
+    # Em produção, use gunicorn com workers gevent atrás de um proxy:
+    #   gunicorn -k gevent -w 2 --worker-connections 1000 app:app
     app.run(host="0.0.0.0", port=5000, debug=False)
\ No newline at end of file